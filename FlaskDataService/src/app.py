@@ -11,64 +11,101 @@
 #
 # ----------------------------------------------------------------------------------------
 
+import os
 import ssl
 import sys
 import eventlet
-import json
+import orjson
 import time
+import queue
+import logging
 import datetime
 import threading
-import zstd
+import zstandard
 
+from eventlet import tpool
 from flask import Flask, render_template, Response
 from flask_cors import CORS
 from flask_mqtt import Mqtt
 from flask_socketio import SocketIO
 from flask_bootstrap import Bootstrap
-from multiprocessing import Queue
 from parser import read_pcd
 
 # Declare app object and set it to Flask class
 app = Flask(__name__)
 CORS(app)
 
+# Logger for MQTT client events, silent unless debug logging is enabled
+logger = logging.getLogger(__name__)
+
 # Declare threading variables
 eventlet.monkey_patch()
-lock = threading.Lock()
-threadedData = []
+messageQueue = queue.Queue(maxsize=100)
+maxBatchSize = 8
 topics = []
 
+# Parsing and compression run on eventlet's pool of real OS threads, one per core,
+# so several frames are worked on at once without blocking the eventlet hub.
+tpool.set_num_threads(os.cpu_count() or 1)
+
+# Zstd compression contexts are reused for every message instead of being set up per call.
+# A context can't be used by two threads at once, so each pool thread keeps its own in
+# real (not green) thread-local storage.
+# Level 1 keeps per-frame compression time low so frames keep up with the sensor rate;
+# higher levels only shave a few percent off the size of the point payload.
+# A dictionary trained offline on past payloads (zstandard.train_dictionary) is used when
+# dict.zstd is deployed next to the app. Its ID is written into every frame header so the
+# client can select the matching dictionary; fzstd in the web app cannot decode these yet.
+compressionDict = None
+if os.path.exists('./dict.zstd'):
+    with open('./dict.zstd', 'rb') as dictFile:
+        compressionDict = zstandard.ZstdCompressionDict(dictFile.read())
+compressorStorage = eventlet.patcher.original('threading').local()
+
+"""Function that parses and compresses a single mqtt message payload.
+Runs on a tpool thread and returns the cleaned values from read_pcd
+with the compressed points stored under 'payload'."""
+def parse_message(payload):
+    compressor = getattr(compressorStorage, 'compressor', None)
+    if compressor is None:
+        compressor = zstandard.ZstdCompressor(level=1, dict_data=compressionDict)
+        compressorStorage.compressor = compressor
+
+    # Pass data to parser
+    values = read_pcd(payload)
+
+    # Compress and store the data and track time of compression
+    start = datetime.datetime.now()
+    values['payload'] = compressor.compress(values['points'])
+    stop = (datetime.datetime.now()-start).total_seconds()
+    return values
+
 """Function that processes mqtt message and compresses the message.
-Message is threaded and passed into read_pcd function to be parsed
-and cleaned. Passes cleaned data to data[]."""
+Message is threaded and passed into parse_message to be parsed,
+cleaned and compressed. Passes cleaned data to data[]."""
 def process_message():
-    global lock
-
-    # Set lock while message is being processed
     while True:
-        lock.acquire()
-        if len(threadedData) > 0:
-            # Pass message to data[]
-            data = threadedData[0]
-            del threadedData[0]
-
-            # Release Threading Lock and pass data to parser
-            lock.release()
-            values = read_pcd( data['payload'])
-
-            # Compress and store the data and track time of compression
-            start = datetime.datetime.now()
-            data['payload'] = zstd.compress(bytes(values['points'], 'utf-8'))
-            stop = (datetime.datetime.now()-start).total_seconds()
+        # Block until a message is queued, then take any others that arrived meanwhile
+        batch = [messageQueue.get()]
+        while len(batch) < maxBatchSize and not messageQueue.empty():
+            batch.append(messageQueue.get_nowait())
+
+        # Parse every frame of the batch in parallel on the thread pool
+        pile = eventlet.GreenPile()
+        for data in batch:
+            pile.spawn(tpool.execute, parse_message, data['payload'])
+
+        for data, values in zip(batch, pile):
+            data['payload'] = values['payload']
             data['objects'] = values['objects']
             data['time'] = values['time']
 
-            # Emits message data and can grab info from the topic
-            socketio.emit('mqtt_message', data=data)
-
+        # Emits message data and can grab info from the topic.
+        # Several frames go out in a single emit when the worker is behind.
+        if len(batch) == 1:
+            socketio.emit('mqtt_message', data=batch[0])
         else:
-            lock.release()
-        time.sleep(.1)
+            socketio.emit('mqtt_message_batch', data=batch)
 
     
 # Threading constructor object
@@ -98,9 +135,8 @@ app.config['MQTT_TLS_VERSION'] = ssl.PROTOCOL_SSLv23
 fpsDict = {}
 countDict = {}
 
-# Variables to check first frame/message and start timer
-mqttFirstFrame = False
-startTime = datetime.datetime.now()
+# Monotonic time of the first frame/message, None until one arrives
+startTime = None
 
 mqtt = Mqtt(app)
 socketio = SocketIO(app, cors_allowed_origins="*")
@@ -114,24 +150,30 @@ def index():
 # App page that returns list of topics found in topic.txt
 @app.route('/topics')
 def findTopics():
-    return Response(json.dumps(topicsAvailable), mimetype='text/json')
+    return Response(orjson.dumps(topicsAvailable), mimetype='application/json')
 
-""" Function that counts fps of the sensor stream.
-Parameters (timeValue: int, topicValue: string)
+""" Function that counts frames of the sensor stream.
+Parameters (topicValue: string)
 topicValue should be topic string obtained from mqtt message."""
-def count_fps_datamesh(timeValue, topicValue):
-    global mqttFirstFrame, startTime
-    duration = 0
+def count_fps_datamesh(topicValue):
+    global startTime
+    if startTime is None:
+        startTime = time.monotonic()
     if topicValue in countDict:
         countDict[topicValue] += 1
-    if not mqttFirstFrame:
-        mqttFirstFrame = True
-        startTime = datetime.datetime.now()
-    else:
-        duration = (datetime.datetime.now() - startTime).total_seconds()
-    if timeValue <= duration:
-        fpsDict[topicValue] = countDict[topicValue] / duration
-        print(fpsDict)
+
+""" Background task that turns the frame counts into fps once a second.
+Parameters (timeValue: int)
+fps is only reported once timeValue seconds have passed since the first frame."""
+def update_fps(timeValue):
+    while True:
+        socketio.sleep(1)
+        if startTime is None:
+            continue
+        duration = time.monotonic() - startTime
+        if timeValue <= duration:
+            for topicValue, count in countDict.items():
+                fpsDict[topicValue] = count / duration
 
 
 # MQTT decorator function to handle connection to broker
@@ -139,19 +181,20 @@ def count_fps_datamesh(timeValue, topicValue):
 def handle_connect(client, userdata, flags, rc):
     #mqtt.subscribe('test15thVirginiaSE')
     #mqtt.subscribe('test15thVirginiaNW')
-    for topic in topics:
-        mqtt.subscribe(topic)
+    # Subscribe to every topic with a single SUBSCRIBE packet
+    if topics:
+        mqtt.subscribe([(topic, 0) for topic in topics])
     # mqtt.subscribe('test2')
 
 @socketio.on('subscribe')
 def handle_subscribe(json_str):
-    data = json.loads(json_str)
+    data = orjson.loads(json_str)
     mqtt.subscribe(data['topic'])
     print("Data ", data)
 
 #@socketio.on('publish')
 #def handle_publish(json_str):
-#    data = json.loads(json_str)
+#    data = orjson.loads(json_str)
 #    mqtt.publish(data['topic'], data['message'])
 
 #@socketio.on('unsubscribe_all')
@@ -167,30 +210,33 @@ def handle_mqtt_message(client, userdata, message):
     )
 
     # Counts the fps of the data stream
-    count_fps_datamesh(10, message.topic)
+    count_fps_datamesh(message.topic)
 
-    lock.acquire()
-    if len(threadedData) < 100:
-        threadedData.append(data)
-    lock.release()
+    # Drop the message if the processing thread has fallen behind
+    try:
+        messageQueue.put_nowait(data)
+    except queue.Full:
+        pass
  
 # MQTT function that handles MQTT logging functionality   
 @mqtt.on_log()
 def handle_logging(client, userdata, level, buf):
-    print(level, buf)
+    logger.debug("%s %s", level, buf)
 
 # Main function
 if __name__ == '__main__':
-    # Open Topic File and Read in available topics
-    topicFile = open('./topic.txt', 'r')
-    topicsAvailable = topicFile.read().split('\n')
+    # Open Topic File and Read in available topics, skipping blank lines
+    with open('./topic.txt', 'r') as topicFile:
+        topicsAvailable = [line.strip() for line in topicFile if line.strip()]
 
     # Loops through lines in text file and adds values to dictionary
     for line in topicsAvailable:
         fpsDict[line] = 0
         countDict[line] = 0
         topics.append(line)
-    topicFile.close()
+
+    # Recompute fps in the background instead of on every message
+    socketio.start_background_task(update_fps, 10)
 
     # Keep reloader set to false otherwise this will create two Flask instances.
     socketio.run(app, host='0.0.0.0', port=5000, use_reloader=False, debug=False)
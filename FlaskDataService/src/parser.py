@@ -5,19 +5,18 @@
 #   Authors: Andrew Munoz, Chase Carthen
 #   Date: 06/15/2021
 #   Purpose: Takes in LiDAR point cloud data and parses through the data.
-#            Reads through PCD file and passes cleaned data to a pandas
-#            dataframe which is then returned to app.py.
+#            Reads through PCD file into a numpy structured array and
+#            returns the cleaned data to app.py.
 #
 # ----------------------------------------------------------------------------------------
 
 import re
 import struct
+import functools
 import warnings
 import datetime
-import json
 
 import numpy as np
-import pandas as pd
 
 # PCD Header Mapping to numpy type
 numpy_pcd_type_mappings = [(np.dtype('float32'), ('F', 4)),
@@ -32,6 +31,9 @@ numpy_pcd_type_mappings = [(np.dtype('float32'), ('F', 4)),
 numpy_type_to_pcd_type = dict(numpy_pcd_type_mappings)
 pcd_type_to_numpy_type = dict((q, p) for (p, q) in numpy_pcd_type_mappings)
 
+# Header line pattern, compiled once since every message header is matched against it
+header_line_regex = re.compile(r'(\w+)\s+([\w\s./]+)')
+
 # Function that parses header objects
 def parse_header(lines): 
     
@@ -47,11 +49,9 @@ def parse_header(lines):
     for ln in lines:
         if ln.startswith('#') or len(ln) < 2:
             continue
-        print(ln)
         if not ln.startswith('end') and searchSwitch:
             coordinates = ln.split(' ')
             positions = {}
-            print(coordinates)
             positions['minx'] = float(coordinates[0])
             positions['maxx'] = float(coordinates[1])
             positions['miny'] = float(coordinates[2])
@@ -60,7 +60,7 @@ def parse_header(lines):
             positions['maxz'] = float(coordinates[5])
             positions['class'] = 'Object'
             metadata['objects'].append(positions)
-        match = re.match('(\w+)\s+([\w\s\.\/]+)', ln)
+        match = header_line_regex.match(ln)
         if not match:
             warnings.warn("warning: can't understand line: %s" % ln)
             continue
@@ -71,11 +71,11 @@ def parse_header(lines):
         elif key in ('fields', 'type'):
             metadata[key] = value.split()
         elif key in ('size', 'count'):
-            metadata[key] = map(int, value.split())
+            metadata[key] = list(map(int, value.split()))
         elif key in ('width', 'height', 'points'):
             metadata[key] = int(value)
         elif key == 'viewpoint':
-            metadata[key] = map(float, value.split())
+            metadata[key] = list(map(float, value.split()))
         elif key == 'data':
             metadata[key] = value.strip().lower()
         elif key == 'minx': #object position values
@@ -92,19 +92,25 @@ def parse_header(lines):
         metadata['viewpoint'] = [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0]
     if 'version' not in metadata:
         metadata['version'] = '.7'
-    print(metadata.get('topic','None'))
     return metadata
 
 """ Function builds numpy structured array dtype from the pcl metadata.
 NOTE: Fields with count > 1 are 'flattened' by creating multiple single-count fields.
 TODO: allow 'proper' multi-count fields."""
 def build_dtype(metadata):
+    # Frames from the same sensor share a layout, so the dtype is looked up by value
+    return build_dtype_cached(tuple(metadata['fields']),
+                              tuple(metadata['count']),
+                              tuple(metadata['type']),
+                              tuple(metadata['size']))
+
+""" Builds the dtype for build_dtype from hashable tuples of the header values.
+Results are cached since numpy dtypes are immutable and safe to share."""
+@functools.lru_cache(maxsize=32)
+def build_dtype_cached(fields, counts, types, sizes):
     fieldnames = []
     typenames = []
-    for f, c, t, s in zip(metadata['fields'],
-                          metadata['count'],
-                          metadata['type'],
-                          metadata['size']):
+    for f, c, t, s in zip(fields, counts, types, sizes):
         np_type = pcd_type_to_numpy_type[(t, s)]
         if c == 1:
             fieldnames.append(f)
@@ -116,16 +122,13 @@ def build_dtype(metadata):
     dtype = np.dtype(list(zip(fieldnames, typenames)))
     return dtype
 
-""" Reads in pcd file and return the elements as pandas Dataframes.
+""" Reads in pcd file and return the elements as a data dictionary.
 Parameters (content: str - Path to the pcd file, isfilename: bool).
-Returns a pandas Dataframe."""
+Returns a dictionary with the topic, time, objects and packed points bytes."""
 def read_pcd(content, isfilename=False): 
     # Initialize data dictionary to store all the cleaned data
     data = {}
 
-    # Initialize json dictionary
-    jsondict = {}
-
     # Loops through pcd file
     if isfilename:
      with open(content, 'rb') as f:
@@ -150,7 +153,7 @@ def read_pcd(content, isfilename=False):
             # for some reason pcl adds empty space at the end of files
             buf = f.read(rowstep)
 
-            pc_data = np.fromstring(buf, dtype=dtype)
+            pc_data = np.frombuffer(buf, dtype=dtype)
 
         elif metadata['data'] == 'binary_compressed':
             raise NotImplementedError("Go ask PCD why they use lzf compression.")
@@ -179,36 +182,28 @@ def read_pcd(content, isfilename=False):
                 ix += bytes
     
     else: 
-        header = []
-        lines = content.split(b'\n')
+        # Only the header is text, so split just the bytes up to the end of the 'Time' line
+        skip = content.find(b'Time ')
+        skip = content.find(b'\n', skip) + 1
+        header = content[:skip].decode('ascii', errors='replace').split('\n')
 
-        for ln in lines:
-            header.append(ln.decode())
+        # Parse the complete header once to get metadata values
+        metadata = parse_header(header)
+        dtype = build_dtype(metadata)
+        topic_value = str(metadata['topic'])
+        time_value = int(metadata['time'])
+        minutes_cal = time_value/6e7
+        minute = int(minutes_cal)
 
-            if ln.startswith(b'DATA'):
-                metadata = parse_header(header)
-                dtype = build_dtype(metadata)
-            elif ln.startswith(b'Time '):
-                metadata = parse_header(header)
-                topic_value = str(metadata['topic'])
-                time_value = int(metadata['time'])
-                print(topic_value)
-                minutes_cal = time_value/6e7
-                minute = int(minutes_cal)
-                break
-
-        skip = content.find(b'Time ')
-        skip = skip + content[skip:].find(b'\n')+1
         rowstep = metadata['points'] * dtype.itemsize
         if metadata['data'] == 'ascii':
             pc_data = np.fromstring(content[skip:], dtype=dtype, delimiter=' ')
 
         elif metadata['data'] == 'binary':
-            #rowstep = metadata['points'] * dtype.itemsize
             # for some reason pcl adds empty space at the end of files
-            #buf = f.read(rowstep)
-
-            pc_data = np.fromstring(content[skip:], dtype=dtype)
+            # Read the points straight out of the payload without copying it
+            mv = memoryview(content)
+            pc_data = np.frombuffer(mv[skip:skip + rowstep], dtype=dtype)
 
         elif metadata['data'] == 'binary_compressed':
             raise NotImplementedError("Go ask PCD why they use lzf compression.")
@@ -237,38 +232,15 @@ def read_pcd(content, isfilename=False):
                 pc_data[dtype.names[dti]] = column
                 ix += bytes
     
-    # Pass in parsed point cloud data to pandas dataframe
-    df = pd.DataFrame(pc_data)
-
-    # Create color string and check if dataframe contains color info
-    col = 'rgb'
-    if col in df.columns:
-        # get the 'rgb' column from dataframe
-        packed_rgb = df.rgb.values
-        # 'rgb' values are stored as float in dataframe. Values converted to int using numpy
-        packed_rgb = packed_rgb.astype(np.float32).tostring()
-        packed_rgb = np.frombuffer(packed_rgb, dtype=np.int32)
-
-        # Values unpacked into 'red', 'green' and 'blue' indices
-        df['red'] = np.asarray((packed_rgb >> 16) & 255, dtype=np.uint8)
-        df['green'] = np.asarray((packed_rgb >> 8) & 255, dtype=np.uint8)
-        df['blue'] = np.asarray(packed_rgb & 255, dtype=np.uint8)
-
-        # Remove packed rgb from dataframe as it is no longer needed
-        df.drop(col, axis=1, inplace=True)
-
     # Cleaned data stored in data dictionary
     data['topic'] = topic_value
     data['time'] = str(minute)
-    data['points'] = df.to_json(index = False, orient = 'split')
     data['objects'] = metadata['objects']
 
-    # Convert Pandas dataframe vertices values into a json dictionary 
-    jsondict['x'] = list(df['x'])
-    jsondict['y'] = list(df['y'])
-    jsondict['z'] = list(df['z'])
-    jsondict['intensity'] = list(df['intensity'])
-    data["points"] = json.dumps(json.loads(json.dumps(jsondict), parse_float=lambda x: round(float(x), 2)))
+    # Vertices values are sent as raw bytes: a little-endian uint32 point count followed
+    # by the x, y, z and intensity values, each as a contiguous little-endian float32 column
+    columns = np.stack([pc_data['x'], pc_data['y'], pc_data['z'], pc_data['intensity']])
+    data['points'] = struct.pack('<I', len(pc_data)) + columns.astype('<f4', copy=False).tobytes()
 
     # Returns clean data dictionary to main Flask app
     return data
\ No newline at end of file
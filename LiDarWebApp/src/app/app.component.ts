@@ -24,9 +24,9 @@ export class PCD{
   topic:string;
 
   //Payload point cloud values
-  x:[];
-  y:[];
-  z:[];
-  intensity:[];
+  x:Float32Array;
+  y:Float32Array;
+  z:Float32Array;
+  intensity:Float32Array;
   objects:any;
 }
@@ -17,9 +17,8 @@ import * as fzstd from 'fzstd';
 export class VisualizationsComponent implements OnInit {
   @ViewChild('flexLayoutContainer') flexLayoutContainerElement: ElementRef;
 
-  // Create Point Cloud and JSON Array to store and pass incoming data from backend to front end dataservice
+  // Create Point Cloud Array to store and pass incoming data from backend to front end dataservice
   public pointCloud : PCD[] = [];
-  parsedJSON: any;
 
   // Create time and message count variables
   pastTime: String;
@@ -128,25 +127,41 @@ export class VisualizationsComponent implements OnInit {
     var app = this;
 
     this.ms.on('mqtt_message', function(value){
-        const compressed = new Uint8Array(value.payload);
-        const uncompressedPayload = fzstd.decompress(compressed);
-        var string = new TextDecoder().decode(uncompressedPayload);
-        console.log(string);
-        this.parsedJSON = JSON.parse(string);
-
-        if (app.pointCloud.length > 2){
-          var val = app.pointCloud.shift();
-          console.log(val);
-        }
+        app.addMessage(value);
+    });
 
-        console.log(app.pointCloud.length);
-        app.pointCloud.push({time: value.time, topic: value.topic, x: this.parsedJSON.x, 
-          y: this.parsedJSON.y, z: this.parsedJSON.z, intensity: this.parsedJSON.intensity, 
-          objects: value.objects});
-        app.ds.Data = app.pointCloud[0];
+    // Backend sends several frames in one event when it is catching up
+    this.ms.on('mqtt_message_batch', function(values){
+        for (const value of values) {
+          app.addMessage(value);
+        }
     });
   }
 
+  // Decompresses a single message and adds it to the point cloud array
+  addMessage(value) {
+    const compressed = new Uint8Array(value.payload);
+    const uncompressedPayload = fzstd.decompress(compressed);
+
+    // Payload is a little-endian uint32 point count followed by the
+    // x, y, z and intensity float32 columns
+    const buffer = uncompressedPayload.buffer;
+    const offset = uncompressedPayload.byteOffset;
+    const count = new DataView(buffer, offset, 4).getUint32(0, true);
+    const columns = new Float32Array(buffer, offset + 4, count * 4);
+
+    if (this.pointCloud.length > 2){
+      var val = this.pointCloud.shift();
+      console.log(val);
+    }
+
+    console.log(this.pointCloud.length);
+    this.pointCloud.push({time: value.time, topic: value.topic, x: columns.subarray(0, count), 
+      y: columns.subarray(count, 2 * count), z: columns.subarray(2 * count, 3 * count), 
+      intensity: columns.subarray(3 * count, 4 * count), objects: value.objects});
+    this.ds.Data = this.pointCloud[0];
+  }
+
   // Allows for charts to be interactable
   onSelect(event) {
     console.log(event);